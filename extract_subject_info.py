@@ -1,46 +1,157 @@
 #!/usr/bin/env python3
 
 import os
+import mmap
+import struct
 import pydicom
 import argparse
-from datetime import datetime
-import csv
+
+TAG_PATIENT_AGE = (0x0010, 0x1010)
+TAG_PATIENT_WEIGHT = (0x0010, 0x1030)
+TAG_PATIENT_SEX = (0x0010, 0x0040)
+TAG_STUDY_DATE = (0x0008, 0x0020)
+TAG_PATIENT_BIRTH_DATE = (0x0010, 0x0030)
+
+# Only these elements are decoded; everything else in the header is skipped
+DEMOGRAPHIC_TAGS = [
+    TAG_PATIENT_AGE,
+    TAG_PATIENT_WEIGHT,
+    TAG_PATIENT_SEX,
+    TAG_STUDY_DATE,
+    TAG_PATIENT_BIRTH_DATE,
+]
 
 def get_first_dicom(directory):
-    for root, _, files in os.walk(directory):
-        for f in files:
-            if f.lower().endswith('.dcm'):
-                return os.path.join(root, f)
+    # Iterative scandir walk: DirEntry type checks reuse the readdir result
+    # (no extra stat per entry) and we return on the first .dcm found.
+    # Like os.walk, symlinked files are listed but symlinked dirs aren't entered
+    stack = [directory]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_file():
+                    if entry.name.lower().endswith('.dcm'):
+                        return entry.path
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
     return None
 
-def extract_fields(dicom_file):
+def _ymd(value):
+    """Split a DICOM DA value (YYYYMMDD) into integer year, month, day."""
+    if len(value) != 8 or not value.isdigit():
+        raise ValueError(f"not a YYYYMMDD date: {value!r}")
+    return int(value[:4]), int(value[4:6]), int(value[6:8])
+
+# Minimal DICOM Part 10 header reader for the demographic tags
+_IMPLICIT_VR_LE = '1.2.840.10008.1.2'
+# Big endian and deflated datasets are left to pydicom
+_UNSUPPORTED_SYNTAXES = {'1.2.840.10008.1.2.2', '1.2.840.10008.1.2.1.99', '1.2.840.10008.1.2.4.95'}
+# Explicit VRs encoded with 2 reserved bytes and a 4-byte length
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM, _ITEM_END, _SEQUENCE_END = 0xE000, 0xE00D, 0xE0DD
+
+def _read_element_header(buf, pos, explicit):
+    """Return (group, element, length, value offset) of the little endian element at pos."""
+    group, elem = struct.unpack_from('<HH', buf, pos)
+    if group == 0xFFFE or not explicit:
+        (length,) = struct.unpack_from('<I', buf, pos + 4)
+        return group, elem, length, pos + 8
+    vr = buf[pos + 4:pos + 6]
+    if not (vr.isalpha() and vr.isupper()):
+        # Dataset doesn't match its transfer syntax; let pydicom sort it out
+        raise ValueError(f"invalid explicit VR {vr!r}")
+    if vr in _LONG_VRS:
+        (length,) = struct.unpack_from('<I', buf, pos + 8)
+        return group, elem, length, pos + 12
+    (length,) = struct.unpack_from('<H', buf, pos + 6)
+    return group, elem, length, pos + 8
+
+def _skip_undefined_length(buf, pos, explicit, end_elem):
+    """Skip a sequence or item of undefined length; return the offset after its (FFFE,end_elem) delimiter."""
+    while True:
+        group, elem, length, pos = _read_element_header(buf, pos, explicit)
+        if group == 0xFFFE and elem == end_elem:
+            return pos
+        if length == _UNDEFINED_LENGTH:
+            nested_end = _ITEM_END if (group == 0xFFFE and elem == _ITEM) else _SEQUENCE_END
+            pos = _skip_undefined_length(buf, pos, explicit, nested_end)
+        else:
+            pos += length
+
+def _parse_demographics(buf):
+    if buf[128:132] != b'DICM':
+        return None
+
+    # File meta information (group 0002) is always explicit VR little endian
+    pos = 132
+    transfer_syntax = None
+    while struct.unpack_from('<H', buf, pos)[0] == 0x0002:
+        group, elem, length, value_pos = _read_element_header(buf, pos, True)
+        if elem == 0x0010:
+            transfer_syntax = buf[value_pos:value_pos + length].rstrip(b'\x00 ').decode('ascii')
+        pos = value_pos + length
+
+    if transfer_syntax is None or transfer_syntax in _UNSUPPORTED_SYNTAXES:
+        return None
+    explicit = transfer_syntax != _IMPLICIT_VR_LE
+
+    wanted = set(DEMOGRAPHIC_TAGS)
+    values = {}
+    while pos < len(buf) and len(values) < len(wanted):
+        group, elem, length, pos = _read_element_header(buf, pos, explicit)
+        if group > 0x0010:
+            break
+        if length == _UNDEFINED_LENGTH:
+            pos = _skip_undefined_length(buf, pos, explicit, _SEQUENCE_END)
+            continue
+        if (group, elem) in wanted:
+            values[(group, elem)] = buf[pos:pos + length].decode('latin-1').strip(' \x00')
+        pos += length
+    return values
+
+def _fast_extract(dicom_file):
+    """
+    Read the demographic tags straight from the file bytes.
+
+    Returns {tag: value} for the tags present, or None when the file is not a
+    Part 10 little endian, non-deflated file (pydicom is used instead).
+    """
     try:
-        dcm = pydicom.dcmread(dicom_file, stop_before_pixels=True)
-    except Exception:
-        return "n/a", "n/a", "n/a"
-
-    TAG_PATIENT_AGE = (0x0010, 0x1010)
-    TAG_PATIENT_WEIGHT = (0x0010, 0x1030)
-    TAG_PATIENT_SEX = (0x0010, 0x0040)
-    TAG_STUDY_DATE = (0x0008, 0x0020)
-    TAG_PATIENT_BIRTH_DATE = (0x0010, 0x0030)
-
-    sex_element = dcm.get(TAG_PATIENT_SEX, None)
-    weight_element = dcm.get(TAG_PATIENT_WEIGHT, None)
-    age_element = dcm.get(TAG_PATIENT_AGE, None)
-
-    sex = sex_element.value if sex_element else 'n/a'
-    if sex == '':
+        with open(dicom_file, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _parse_demographics(buf)
+    except (OSError, ValueError, struct.error):
+        return None
+
+def extract_fields(dicom_file):
+    values = _fast_extract(dicom_file)
+    if values is None:
+        try:
+            # Parse from a memory map so pydicom's small header reads don't each
+            # turn into a read() syscall
+            with open(dicom_file, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                dcm = pydicom.dcmread(mm, stop_before_pixels=True, specific_tags=DEMOGRAPHIC_TAGS)
+        except Exception:
+            return "n/a", "n/a", "n/a"
+        values = {tag: dcm[tag].value for tag in DEMOGRAPHIC_TAGS if tag in dcm}
+
+    sex = values.get(TAG_PATIENT_SEX, 'n/a')
+    if sex in ('', None):
         sex = 'n/a'
 
-    weight = weight_element.value if weight_element else 'n/a'
-    if weight == '':
+    weight = values.get(TAG_PATIENT_WEIGHT, 'n/a')
+    if weight in ('', None):
         weight = 'n/a'
     else:
         weight = str(weight)
 
-    if age_element and age_element.value != '':
-        age_raw = str(age_element.value)
+    age_value = values.get(TAG_PATIENT_AGE)
+    if age_value not in ('', None):
+        age_raw = str(age_value)
         if age_raw[-1] in ['Y', 'M', 'D']:
             age_raw = age_raw[:-1]
         try:
@@ -48,13 +159,13 @@ def extract_fields(dicom_file):
         except ValueError:
             age = age_raw
     else:
-        study_date_element = dcm.get(TAG_STUDY_DATE, None)
-        birth_date_element = dcm.get(TAG_PATIENT_BIRTH_DATE, None)
-        if study_date_element and birth_date_element:
+        study_date = values.get(TAG_STUDY_DATE)
+        birth_date = values.get(TAG_PATIENT_BIRTH_DATE)
+        if study_date and birth_date:
             try:
-                dob = datetime.strptime(birth_date_element.value, '%Y%m%d')
-                study_date = datetime.strptime(study_date_element.value, '%Y%m%d')
-                age_years = study_date.year - dob.year - ((study_date.month, study_date.day) < (dob.month, dob.day))
+                dy, dm, dd = _ymd(birth_date)
+                sy, sm, sd = _ymd(study_date)
+                age_years = sy - dy - ((sm, sd) < (dm, dd))
                 age = str(age_years)
             except Exception:
                 age = 'n/a'
@@ -63,48 +174,113 @@ def extract_fields(dicom_file):
 
     return sex, weight, age
 
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def _read_tsv_rows(path):
+    """Yield the rows of a TSV file as lists, header first, skipping blank lines."""
+    # participants.tsv is plain TSV (no quoting, IDs never contain tabs or
+    # newlines), so rows are handled as split/joined lists rather than csv dicts
+    with open(path, 'r', encoding='utf-8') as f:
+        first_char = f.read(1)
+        if first_char != '\ufeff':
+            f.seek(0)
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line.split('\t')
+
+def _fit_row(row, cols, n):
+    """Bring a row to the expected column layout (cols is None when the header already matches)."""
+    if cols is None:
+        return row if len(row) == n else (row + [''] * n)[:n]
+    return [row[c] if c is not None and c < len(row) else '' for c in cols]
+
+def _session_matches(ses, session_id):
+    # Update if exact match of session_id OR if existing session_id is 'n/a' and you want to update it
+    return ses == session_id or (ses == 'n/a' and session_id != 'n/a')
+
+def _apply_updates(row, pending, applied):
+    for values in pending.get(row[0], ()):
+        if id(values) not in applied and _session_matches(row[1], values[1]):
+            row[1:] = values[1:]  # overwrites n/a with actual session
+            applied.add(id(values))
+
+def _new_rows(updates, applied):
+    """Rows for updates that matched nothing in the file, merged among themselves."""
+    new_rows = []
+    for values in updates:
+        if id(values) in applied:
+            continue
+        for row in new_rows:
+            if row[0] == values[0] and _session_matches(row[1], values[1]):
+                row[1:] = values[1:]
+                break
+        else:
+            new_rows.append(list(values))
+    return new_rows
+
 def update_participants_tsv(participants_tsv_path, subject_id, session_id, sex, weight, age):
+    update_participants_tsv_batch(participants_tsv_path, [(subject_id, session_id, sex, weight, age)])
+
+def update_participants_tsv_batch(participants_tsv_path, updates):
+    """
+    Apply several (subject_id, session_id, sex, weight, age) updates to
+    participants.tsv without holding the file in memory.
+
+    If every update is a new participant/session the rows are appended.
+    Otherwise the file is streamed into participants.tsv.tmp with the
+    updates applied, and the temp file replaces the original atomically.
+    """
     headers = ["participant_id", "session_id", "sex", "weight", "age"]
-    rows = []
+    n = len(headers)
+    updates = [[str(v) for v in values] for values in updates]
+    pending = {}  # participant_id -> updates for that participant, in order
+    for values in updates:
+        pending.setdefault(values[0], []).append(values)
 
+    fieldnames = None
     if os.path.exists(participants_tsv_path):
-        with open(participants_tsv_path, 'r', encoding='utf-8') as f:
-            first_char = f.read(1)
-            if first_char != '\ufeff':
-                f.seek(0)
-            reader = csv.DictReader(f, delimiter='\t')
-            rows = list(reader)
-
-    updated = False
-    for row in rows:
-        pid = row.get("participant_id", "")
-        ses = row.get("session_id", "")
-
-        if pid == subject_id:
-            # Update if exact match of session_id OR if existing session_id is 'n/a' and you want to update it
-            if ses == session_id or (ses == 'n/a' and session_id != 'n/a'):
-                row["session_id"] = session_id  # overwrite n/a with actual session
-                row["sex"] = sex
-                row["weight"] = weight
-                row["age"] = age
-                updated = True
-                break
+        rows = _read_tsv_rows(participants_tsv_path)
+        fieldnames = next(rows, None)
+        if fieldnames == headers:
+            has_match = any(
+                _session_matches(_fit_row(row, None, n)[1], values[1])
+                for row in rows
+                for values in pending.get(row[0], ())
+            )
+            rows.close()
+            if not has_match:
+                with open(participants_tsv_path, 'a', encoding='utf-8', newline='') as f:
+                    if not _ends_with_newline(participants_tsv_path):
+                        f.write('\n')
+                    f.writelines('\t'.join(row) + '\n' for row in _new_rows(updates, set()))
+                return
+        else:
+            rows.close()
+
+    cols = None
+    if fieldnames is not None and fieldnames != headers:
+        cols = [fieldnames.index(h) if h in fieldnames else None for h in headers]
 
-    if not updated:
-        new_row = {h: '' for h in headers}
-        new_row["participant_id"] = subject_id
-        new_row["session_id"] = session_id
-        new_row["sex"] = sex
-        new_row["weight"] = weight
-        new_row["age"] = age
-        rows.append(new_row)
-
-    with open(participants_tsv_path, 'w', encoding='utf-8', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=headers, delimiter='\t')
-        writer.writeheader()
-        for row in rows:
-            clean_row = {h: row.get(h, '') for h in headers}
-            writer.writerow(clean_row)
+    applied = set()
+    tmp_path = f"{os.fspath(participants_tsv_path)}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='', buffering=1 << 20) as out:
+        out.write('\t'.join(headers) + '\n')
+        if fieldnames is not None:
+            rows = _read_tsv_rows(participants_tsv_path)
+            next(rows)
+            for row in rows:
+                row = _fit_row(row, cols, n)
+                _apply_updates(row, pending, applied)
+                out.write('\t'.join(row) + '\n')
+        out.writelines('\t'.join(row) + '\n' for row in _new_rows(updates, applied))
+    os.replace(tmp_path, participants_tsv_path)
 
 def main(dicom_path, subject_id, session_id, participants_tsv):
     dicom_file = get_first_dicom(dicom_path)
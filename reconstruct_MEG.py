@@ -23,6 +23,7 @@
 #
 
 
+import os
 import sys
 import subprocess
 import importlib.util
@@ -30,6 +31,13 @@ import re
 import traceback
 from pathlib import Path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Precompiled filename patterns
+_SUB_PREFIX = re.compile(r'^sub[-_]', re.I)
+_SEP = re.compile(r'[-_]')
+# sub[-_]subjectid[_-]task+run[_-]raw...
+_FNAME_PAT = re.compile(r'^(?:sub[-_]?)?(?P<sub>[a-z0-9]+)[-_](?P<task>[a-z]+)(?P<run>\d*)[_-]raw')
 
 # Function to check if a package is installed
 def install_if_missing(package_name):
@@ -67,12 +75,12 @@ def normalize_subject_id(subj_id):
         'sub-BRS0170' -> 'BRS0170'
     """
     # remove any 'sub-' or 'sub_' prefix
-    subj = re.sub(r'^sub[-_]', '', subj_id, flags=re.I)
+    subj = _SUB_PREFIX.sub('', subj_id)
     # remove any other dashes/underscores and uppercase letters
-    subj = re.sub(r'[-_]', '', subj).upper()
+    subj = _SEP.sub('', subj).upper()
     return subj
 
-def subject_has_invalid_files(session_folder, subject_dir):
+def subject_has_invalid_files(session_folder, entries, expected_sub_id):
     """
     Validate MEG filenames in the session folder.
 
@@ -84,36 +92,46 @@ def subject_has_invalid_files(session_folder, subject_dir):
     - If BIDS (--bids set): require NO separators before the block/task/run.
       Example valid only for BIDS:
           decodingspeechpilot001_block1.fif
+
+    entries are the session's file DirEntries; expected_sub_id is the already
+    normalized subject ID (see normalize_subject_id).
     """
-    expected_sub_id = normalize_subject_id(subject_dir)
     print(f"Checking session folder: {session_folder}")
     print(f"Expected subject ID: {expected_sub_id}")
 
-    for f in session_folder.iterdir():
-        if f.is_file() and f.suffix.lower() in [".fif", ".fif.gz"]:
-            fname = f.stem
-            if do_bids:
-                if expected_sub_id.upper() not in fname.upper():
-                    log_error(
-                        f"{f.name} contains unexpected subject ID (expected {expected_sub_id})"
-                    )
-                    return True
-                else:
-                    print(f"File OK for BIDS: {f.name} contains expected subject ID")
+    for entry in entries:
+        name = entry.name
+        name_lower = name.lower()
+        if name_lower.endswith(".fif"):
+            fname = name[:-len(".fif")]
+        elif name_lower.endswith(".fif.gz"):
+            fname = name[:-len(".fif.gz")]
+        else:
+            continue
 
+        if do_bids:
+            # expected_sub_id is already upper case (normalize_subject_id)
+            if expected_sub_id not in fname.upper():
+                log_error(
+                    f"{name} contains unexpected subject ID (expected {expected_sub_id})"
+                )
+                return True
             else:
-                # Normalize filename
-                fname_norm = normalize_subject_id(fname)
-
-                # Check if filename starts with expected normalized ID
-                if not fname_norm.startswith(expected_sub_id):
-                    log_error(
-                        f"{f.name} contains unexpected subject ID "
-                        f"(normalized filename '{fname_norm}', expected prefix '{expected_sub_id}')"
-                    )
-                    return True
-                else:
-                    print(f"File OK for copying: {f.name}")
+                print(f"File OK for BIDS: {name} contains expected subject ID")
+
+        else:
+            # Normalize filename
+            fname_norm = normalize_subject_id(fname)
+
+            # Check if filename starts with expected normalized ID
+            if not fname_norm.startswith(expected_sub_id):
+                log_error(
+                    f"{name} contains unexpected subject ID "
+                    f"(normalized filename '{fname_norm}', expected prefix '{expected_sub_id}')"
+                )
+                return True
+            else:
+                print(f"File OK for copying: {name}")
     return False
 #            # Check if expected_sub_id is in filename, ignoring case
 #            if expected_sub_id.upper() not in f.stem.upper():
@@ -124,26 +142,60 @@ def subject_has_invalid_files(session_folder, subject_dir):
 #
 #    return False
 
-# --- Pre-check all sessions first ---
+def scan_session(session_folder):
+    """Return the files (including symlinks to files) in a session folder as DirEntries."""
+    with os.scandir(session_folder) as it:
+        return [e for e in it if e.is_file()]
+
+# --- Scan and pre-check all sessions in a single pass ---
+# The file listing gathered here is reused by the copy/BIDS loop below,
+# so no session folder is read twice
 invalid_subject = False
 print(f"\nChecking subject {subject_dir.name} for invalid files...")
-for session_folder in subject_dir.iterdir():
-    if session_folder.is_dir():
-        if subject_has_invalid_files(session_folder, subject_dir.name):
-            log_error(f"Skipping subject {subject_dir.name} because session '{session_folder.name}' contains invalid files")
-            invalid_subject = True
-            break  # skip entire subject if any session has invalid files
+expected_sub_id = normalize_subject_id(subject_dir.name)
+session_map = {}  # session folder -> list of its file DirEntries
+with os.scandir(subject_dir) as it:
+    session_dirs = [Path(e.path) for e in it if e.is_dir()]
+# Session listings are independent and I/O-bound, so read them concurrently
+with ThreadPoolExecutor(max_workers=max(1, min(8, len(session_dirs)))) as ex:
+    session_listings = list(ex.map(scan_session, session_dirs))
+for session_folder, entries in zip(session_dirs, session_listings):
+    if subject_has_invalid_files(session_folder, entries, expected_sub_id):
+        log_error(f"Skipping subject {subject_dir.name} because session '{session_folder.name}' contains invalid files")
+        invalid_subject = True
+        break  # skip entire subject if any session has invalid files
+    session_map[session_folder] = entries
 
 if invalid_subject:
     print(f"ERROR: Subject {subject_dir.name} MEG processing skipped due to invalid files.\n")
     sys.exit(0)
 
+esi = None
 if do_bids:
     install_if_missing('mne_bids')
+    try:
+        import extract_subject_info as esi
+    except ImportError as e:
+        log_error(f"Cannot import extract_subject_info.py, demographics will not be extracted: {e}")
 
 import mne
 from mne_bids import BIDSPath, write_raw_bids
 
+def copy_if_changed(entry, dest_dir):
+    """
+    Copy a session file into dest_dir unless an up-to-date copy is already
+    there (same size and not older than the source).
+    """
+    dest = dest_dir / entry.name
+    src_st = entry.stat()
+    try:
+        dst_st = os.stat(dest)
+        needs_copy = dst_st.st_size != src_st.st_size or dst_st.st_mtime < src_st.st_mtime
+    except FileNotFoundError:
+        needs_copy = True
+    if needs_copy:
+        shutil.copy2(entry.path, dest)
+
 # Define and create output paths
 reconstructed_base = Path(f"/data/storage/projects/{project_name}/meg")  # TO DO: CHANGE TEST-PROJECT
 reconstructed_path = reconstructed_base / "reconstructed"
@@ -153,44 +205,66 @@ raw_path = reconstructed_base / "raw"
 reconstructed_path.mkdir(parents=True, exist_ok=True)
 raw_path.mkdir(parents=True, exist_ok=True)
 failed_bids_files = []
-for session_folder in subject_dir.iterdir():
-    if session_folder.is_dir():
+participants_tsv = reconstructed_path / "participants.tsv"
+pending_updates = []  # demographics rows, written to participants_tsv once at the end
+dir_subject_id = subject_dir.name.replace('_', '').replace('sub-', '').replace('sub_', '').upper()
+try:
+    for session_folder, entries in session_map.items():
         session_id_short = session_folder.name
         session_id = f"20{session_id_short}"
         print(f"\nFound session: {session_id}")
 
-        meg_files = list(session_folder.glob("*.fif"))
+        meg_files = [e for e in entries if e.name.lower().endswith('.fif')]
         if not meg_files:
             log_error(f"  No .fif files found in session '{session_folder}' (session ID: {session_id})")
             continue
 
         # Create subject/session folders in raw
-        subject_id = subject_dir.name.replace('_', '').replace('sub-', '').replace('sub_', '').upper()
-        raw_subj_ses_dir = raw_path / f"sub-{subject_id}" / f"ses-{session_id}"
+        raw_subj_ses_dir = raw_path / f"sub-{dir_subject_id}" / f"ses-{session_id}"
         raw_subj_ses_dir.mkdir(parents=True, exist_ok=True)
 
         # Copy all files from session_folder to raw_subj_ses_dir
-        for item in session_folder.iterdir():
-            if item.is_file():
-                dest = raw_subj_ses_dir / item.name
-                if not dest.exists():
-                    shutil.copy2(item, dest)
-        print(f"    Copied raw MEG files to: {raw_subj_ses_dir} (existing files were NOT overwritten)")
+        # Copies are I/O-bound, so overlap them with a small thread pool
+        with ThreadPoolExecutor(max_workers=min(8, len(entries))) as ex:
+            list(ex.map(lambda item: copy_if_changed(item, raw_subj_ses_dir), entries))
+        print(f"    Copied raw MEG files to: {raw_subj_ses_dir} (up-to-date files were NOT re-copied)")
 
         # If --bids flag set, also convert to BIDS
         if do_bids:
-            subject_bids_dir = reconstructed_path / f"sub-{subject_id}" / f"ses-{session_id}"
+            subject_bids_dir = reconstructed_path / f"sub-{dir_subject_id}" / f"ses-{session_id}"
             if subject_bids_dir.exists() and any(subject_bids_dir.iterdir()):
                 print(f"BIDS folder already exists and is not empty: {subject_bids_dir}. Skipping BIDS conversion.")
             else:
+                # Subject ID the BIDS output of this session was written under
+                # (taken from the filenames, defaults to the directory-derived ID)
+                bids_subject_id = dir_subject_id
+                loaded_files = set()  # every file read so far, including split-file continuations
                 for raw_meg in meg_files:
                     print(f"  Processing MEG file: {raw_meg.name}")
+                    if os.path.realpath(raw_meg.path) in loaded_files:
+                        print(f"    Already loaded as part of a split recording. Skipping.")
+                        continue
+
+                    # Parse filename to extract subject ID, task, run robustly
+                    # (before loading, so unparseable files never have their header read)
+                    fname = raw_meg.name.lower()[:-len('.fif')]
+
+                    m = _FNAME_PAT.match(fname)
+                    if m:
+                        file_subject_id = m.group('sub').upper()
+                        task = m.group('task')
+                        run = int(m.group('run')) if m.group('run') else None
+                    else:
+                        log_error(f"    WARNING: Could not parse subject/task from filename '{raw_meg.name}'. Skipping this file.")
+                        continue
+
                     try:
-                        raw = mne.io.read_raw_fif(raw_meg, verbose=False)
+                        raw = mne.io.read_raw_fif(raw_meg.path, verbose=False)
                         print(f"    Loaded file successfully.")
                     except Exception as e:
                         log_error(f"    Failed to load {raw_meg.name}: {e}")
                         continue
+                    loaded_files.update(os.path.realpath(f) for f in raw.filenames if f)
 
                     # Clear birthday to avoid mne_bids errors
                     if raw.info.get("subject_info") and "birthday" in raw.info["subject_info"]:
@@ -200,31 +274,8 @@ for session_folder in subject_dir.iterdir():
                         raw.info["subject_info"]["sex"] = 0 # SET TO N/A FOR NOW
                         raw.info["subject_info"]["hand"] = 0 # SET TO N/A FOR NOW
 
-                    # Parse filename to extract subject_id, task, run robustly
-                    fname = raw_meg.name.lower().replace('.fif', '').replace('.fif.gz', '')
-
-                    # Regex pattern to capture:
-                    #  sub[-_]subjectid[_-]task+run[_-]raw...
-                    pattern = r'^(?:sub[-_]?)?([a-z0-9]+)[-_]([a-z]+[0-9]*)[_-]raw'
-                    m = re.match(pattern, fname)
-                    if m:
-                        subject_id = m.group(1).upper()
-                        task_run_str = m.group(2)
-                    else:
-                        log_error(f"    WARNING: Could not parse subject/task from filename '{raw_meg.name}'. Skipping this file.")
-                        continue
-
-                    # Extract task and optional run number from task_run_str
-                    m_task = re.match(r'([a-z]+)(\d*)', task_run_str)
-                    if m_task:
-                        task = m_task.group(1)
-                        run = int(m_task.group(2)) if m_task.group(2) else None
-                    else:
-                        log_error(f"    WARNING: Could not parse task/run from '{task_run_str}'. Skipping this file.")
-                        continue
-
                     bids_path = BIDSPath(
-                        subject=subject_id,
+                        subject=file_subject_id,
                         session=session_id,
                         task=task,
                         run=run,
@@ -243,6 +294,7 @@ for session_folder in subject_dir.iterdir():
                             verbose=True
                         )
                         print("    BIDS conversion complete")
+                        bids_subject_id = file_subject_id
 
                     except Exception as e:
                         log_error(f"    Failed to write BIDS: {e}")
@@ -256,48 +308,57 @@ for session_folder in subject_dir.iterdir():
                         print(f"  {f}")
 
                 # Move BIDS output files up one level and remove 'meg' folder
-                subject_bids_dir = reconstructed_path / f"sub-{subject_id}" / f"ses-{session_id}"
+                subject_bids_dir = reconstructed_path / f"sub-{bids_subject_id}" / f"ses-{session_id}"
                 meg_folder = subject_bids_dir / "meg"
 
                 if meg_folder.exists():
-                    for f in meg_folder.iterdir():
+                    # List the folder fully before moving anything out of it
+                    with os.scandir(meg_folder) as it:
+                        meg_entries = list(it)
+
+                    # Same filesystem, so each move is a rename; os.replace also
+                    # overwrites an existing file at the destination atomically
+                    for f in meg_entries:
                         dest = subject_bids_dir / f.name
 
-                        # Remove existing file or directory at destination
-                        if dest.exists():
-                            if dest.is_dir():
-                                shutil.rmtree(dest)
-                            else:
-                                dest.unlink()
+                        # Directories can't be replaced in place; remove them first
+                        if dest.is_dir():
+                            shutil.rmtree(dest)
+                        elif f.is_dir(follow_symlinks=False) and dest.exists():
+                            dest.unlink()
 
-                        shutil.move(str(f), str(dest))
+                        os.replace(f.path, dest)
 
                     shutil.rmtree(meg_folder)
                     print(f"    Moved contents and removed: {meg_folder}")
 
-                # --- Call demographics extraction script ---
-                participants_tsv = reconstructed_path / "participants.tsv"
-
-                # Create participants.tsv with header if it doesn't exist
-                if not participants_tsv.exists():
-                    with participants_tsv.open('w') as f:
-                        f.write("participant_id\tsession_id\tsex\tweight\tage\n")
-
-                # Build DICOM path (raw_sorted_dir) and call script
-                raw_sorted_dir = f"/data/storage/projects/{project_name}/mri/raw_sorted/sub-{subject_id}/ses-{session_id}"
-
-                extract_script = Path("/data/storage/software/extract_subject_info.py")
-                cmd = [
-                    "python3", str(extract_script),
-                    "--dicom_path", str(raw_sorted_dir),
-                    "--subject_id", f"sub-{subject_id}",
-                    "--session_id", f"ses-{session_id}",
-                    "--participants_tsv", str(participants_tsv)
-                ]
+                # --- Extract demographics from the session's DICOMs ---
+                raw_sorted_dir = f"/data/storage/projects/{project_name}/mri/raw_sorted/sub-{bids_subject_id}/ses-{session_id}"
+
+                if esi is None:
+                    log_error(f"    Skipping demographics for {bids_subject_id} / {session_id}: extract_subject_info.py unavailable")
+                    continue
+                print(f"    Extracting demographics for {bids_subject_id} / {session_id}")
                 try:
-                    print(f"    Running extract_subject_info.py for {subject_id} / {session_id}")
-                    subprocess.run(cmd, check=True)
-                except subprocess.CalledProcessError as e:
-                    log_error(f"    ERROR running extract_subject_info.py: {e}")
+                    dicom = esi.get_first_dicom(raw_sorted_dir)
+                    if dicom:
+                        sex, weight, age = esi.extract_fields(dicom)
+                        print(f"    Extracted from DICOM: sex='{sex}', weight='{weight}', age='{age}'")
+                    else:
+                        sex, weight, age = ('n/a',) * 3
+                        print(f"    No DICOM file found in {raw_sorted_dir}")
+                except Exception as e:
+                    log_error(f"    ERROR extracting demographics for {bids_subject_id} / {session_id}: {e}")
+                    continue
+                pending_updates.append((f"sub-{bids_subject_id}", f"ses-{session_id}", sex, weight, age))
+finally:
+    # --- Write all demographics to participants.tsv in one pass ---
+    # Runs even if the loop above fails, so converted sessions keep their rows
+    if pending_updates:
+        try:
+            esi.update_participants_tsv_batch(participants_tsv, pending_updates)
+            print(f"\nUpdated {participants_tsv} with {len(pending_updates)} session(s)")
+        except OSError as e:
+            log_error(f"Failed to update {participants_tsv}: {e}")
 
 print("\nAll MEG files have been processed.")